@@ -0,0 +1,102 @@
+import argparse
+import os
+import time
+
+import cv2
+import numpy as np
+import torch
+from segment_anything import SamPredictor
+
+from saminference import build_sam, configure_threads, encoder_precisions
+
+sam_checkpoint = "./models/sam_vit_b_01ec64.pth"
+model_type = "vit_b"
+
+image_suffixes = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff")
+
+# Prompts every sample image is segmented with, one positive point each, as fractions of the image size.
+prompt_fractions = [(0.5, 0.5), (0.25, 0.25), (0.75, 0.25), (0.25, 0.75), (0.75, 0.75)]
+
+
+def load_samples(sample_dir):
+    samples = []
+    for name in sorted(os.listdir(sample_dir)):
+        if not name.lower().endswith(image_suffixes):
+            continue
+        image = cv2.imread(os.path.join(sample_dir, name), cv2.IMREAD_COLOR)
+        if image is None:
+            print("skipping " + name + ": cannot be read")
+            continue
+        samples.append((name, cv2.cvtColor(image, cv2.COLOR_BGR2RGB)))
+    return samples
+
+
+def iou(a, b):
+    union = np.count_nonzero(a | b)
+    if union == 0:
+        return 1.0
+    return np.count_nonzero(a & b) / union
+
+
+# Encode every sample repeat times with the model, keeping the fastest time of each, and segment it with the
+# fixed prompts. Returns the per-image encoder latencies in seconds and the masks of every sample.
+def run(sam, samples, repeat):
+    predictor = SamPredictor(sam)
+    latencies = []
+    masks = []
+    for name, image in samples:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            predictor.set_image(image)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        latencies.append(best)
+        h, w = image.shape[:2]
+        sample_masks = []
+        for fx, fy in prompt_fractions:
+            mask, _, _ = predictor.predict(point_coords=np.array([[fx * w, fy * h]]), point_labels=np.array([1]),
+                                           multimask_output=False)
+            sample_masks.append(mask[0])
+        masks.append(sample_masks)
+    return latencies, masks
+
+
+# Compare encoder precisions against fp32 on a fixed set of sample images: encoder latency, and mask IoU
+# against the fp32 masks for the same prompts.
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("sample_dir", help="directory of sample images, for example tone mapped exports")
+    parser.add_argument("--precisions", nargs="+", choices=encoder_precisions, default=["int8", "bf16"],
+                        help="precisions compared against fp32")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--torch-threads", type=int, default=None)
+    parser.add_argument("--torch-interop-threads", type=int, default=None)
+    parser.add_argument("--repeat", type=int, default=3, help="encoder runs per image, the fastest is reported")
+    parser.add_argument("--checkpoint", default=sam_checkpoint)
+    args = parser.parse_args()
+
+    configure_threads(args.torch_threads, args.torch_interop_threads)
+    samples = load_samples(args.sample_dir)
+    if not samples:
+        raise SystemExit("no sample images in " + args.sample_dir)
+    print(str(len(samples)) + " samples, " + str(len(prompt_fractions)) + " prompts each")
+
+    results = {}
+    reference = None
+    for precision in ["fp32"] + [p for p in args.precisions if p != "fp32"]:
+        sam = build_sam(model_type, args.checkpoint, args.device, precision)
+        with torch.inference_mode():
+            latencies, masks = run(sam, samples, args.repeat)
+        if reference is None:
+            reference = masks
+        ious = [iou(mask, reference_mask) for sample_masks, reference_masks in zip(masks, reference)
+                for mask, reference_mask in zip(sample_masks, reference_masks)]
+        results[precision] = (np.mean(latencies), np.mean(ious), np.min(ious))
+        del sam
+
+    fp32_latency = results["fp32"][0]
+    print("precision  encoder ms  speedup  mean IoU  IoU drop  worst IoU")
+    for precision, (latency, mean_iou, worst_iou) in results.items():
+        print("%-9s  %10.1f  %6.2fx  %8.4f  %8.4f  %9.4f" % (precision, latency * 1000, fp32_latency / latency,
+                                                            mean_iou, 1 - mean_iou, worst_iou))
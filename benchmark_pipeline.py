@@ -0,0 +1,309 @@
+import argparse
+import contextlib
+import gzip
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+
+import cv2
+import numpy as np
+
+import main
+from embeddingcache import EmbeddingCache
+from metrics import metrics
+from protocol import pack_modify, pack_points, recv_bytes, send_frame
+from quantizedmesh import header_size, oct_vertex_normals_extension, watermask_extension
+
+tile_size = 256
+watermask_size = 256
+
+
+# Synthetic quantized-mesh tile with random vertices, oct-encoded normals and a watermask, which is left out when
+# None, a single byte for an all land (0) or all water (255) tile, or a 256x256 uint8 array.
+# Above 65536 vertices the indices are 32 bits wide and start 4-byte aligned, as the format specifies.
+def tile_data(rng, vertex_count, watermask):
+    data = bytearray(header_size)
+    data += struct.pack("<I", vertex_count)
+    data += rng.integers(0, 32768, vertex_count * 3, dtype=np.uint16).tobytes()
+    index_type = np.uint32 if vertex_count > 65536 else np.uint16
+    data += bytes(-len(data) % np.dtype(index_type).itemsize)
+    triangle_count = vertex_count * 2
+    data += struct.pack("<I", triangle_count)
+    data += rng.integers(0, vertex_count, triangle_count * 3, dtype=index_type).tobytes()
+    for _ in range(4):
+        data += struct.pack("<I", 2) + rng.integers(0, vertex_count, 2, dtype=index_type).tobytes()
+    data += struct.pack("<BI", oct_vertex_normals_extension, vertex_count * 2)
+    data += rng.integers(0, 256, vertex_count * 2, dtype=np.uint8).tobytes()
+    if isinstance(watermask, int):
+        data += struct.pack("<BIB", watermask_extension, 1, watermask)
+    elif watermask is not None:
+        data += struct.pack("<BI", watermask_extension, watermask.size) + watermask.tobytes()
+    return bytes(data)
+
+
+# Watermask of a synthetic tile: a quarter each without watermask, all land, all water and with a random shore.
+def random_watermask(rng):
+    kind = rng.integers(4)
+    if kind == 0:
+        return None
+    if kind == 1:
+        return 0
+    if kind == 2:
+        return 255
+    watermask = np.zeros((watermask_size, watermask_size), dtype=np.uint8)
+    shore = rng.integers(watermask_size // 4, watermask_size * 3 // 4)
+    watermask[:, :shore] = 255
+    return watermask
+
+
+# Write a pyramid of synthetic tiles: span x span tiles at lod from bottom_left, and all their descendants
+# depth levels down. The location is a directory, or an MBTiles file by its suffix like open_terrain_store() takes.
+# Returns the number of tiles written.
+def build_pyramid(location, lod, bottom_left, span, depth, vertex_count, compressed, seed):
+    rng = np.random.default_rng(seed)
+    tiles = []
+    x0, y0 = bottom_left
+    for level in range(depth + 1):
+        scale = 2 ** level
+        for x in range(x0 * scale, (x0 + span) * scale):
+            for y in range(y0 * scale, (y0 + span) * scale):
+                data = tile_data(rng, vertex_count, random_watermask(rng))
+                if compressed:
+                    data = gzip.compress(data, compresslevel=6)
+                tiles.append((lod + level, x, y, data))
+    if location.lower().endswith((".mbtiles", ".sqlite", ".db")):
+        with contextlib.closing(sqlite3.connect(location)) as connection, connection:
+            connection.execute(
+                "CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, "
+                "tile_data BLOB, PRIMARY KEY (zoom_level, tile_column, tile_row))")
+            connection.executemany("INSERT INTO tiles VALUES (?, ?, ?, ?)", tiles)
+    else:
+        for level, x, y, data in tiles:
+            os.makedirs(os.path.join(location, str(level), str(x)), exist_ok=True)
+            with open(os.path.join(location, str(level), str(x), str(y) + ".terrain"), "wb") as file:
+                file.write(data)
+    return len(tiles)
+
+
+# Synthetic HDR export of the view, encoded as a float TIFF since cv2 does not always write EXR.
+def export_image(width, seed):
+    rng = np.random.default_rng(seed)
+    image = rng.random((width, width, 3), dtype=np.float32) * 4
+    ok, encoded = cv2.imencode(".tiff", image)
+    return encoded.tobytes()
+
+
+class StubTransform:
+    def apply_coords(self, coords, original_size):
+        return coords
+
+    def apply_boxes(self, boxes, original_size):
+        return boxes
+
+
+class StubFeatures:
+    def to(self, device):
+        return self
+
+
+# Stands in for SamPredictor: takes encode_ms per image instead of running the encoder, and hands prompts
+# to the decoder in image coordinates.
+class StubPredictor:
+    device = "cpu"
+
+    def __init__(self, encode_ms=0):
+        self.encode_ms = encode_ms
+        self.transform = StubTransform()
+        self.reset_image()
+
+    def set_image(self, image):
+        time.sleep(self.encode_ms / 1000)
+        self.original_size = image.shape[:2]
+        self.input_size = image.shape[:2]
+        self.features = StubFeatures()
+        self.is_image_set = True
+
+    def reset_image(self):
+        self.original_size = None
+        self.input_size = None
+        self.features = None
+        self.is_image_set = False
+
+
+# Stands in for the mask decoder, see onnxdecoder.OnnxDecoder.predict(). A group's mask is a disc of radius
+# pixels around each positive point and its box, less discs around its negative points; it takes decode_ms.
+class StubDecoder:
+    def __init__(self, radius, decode_ms=0):
+        self.radius = radius
+        self.decode_ms = decode_ms
+
+    def predict(self, predictor, point_coords, point_labels, boxes, mask_input):
+        time.sleep(self.decode_ms / 1000)
+        count = len(point_coords) if point_coords is not None else len(boxes)
+        height, width = predictor.original_size
+        yy, xx = np.ogrid[:height, :width]
+        masks = np.zeros((count, height, width), dtype=bool)
+        for k in range(count):
+            if boxes is not None:
+                x0, y0, x1, y1 = boxes[k]
+                masks[k, int(y0):int(y1) + 1, int(x0):int(x1) + 1] = True
+            if point_coords is None:
+                continue
+            for (x, y), label in zip(point_coords[k], point_labels[k]):
+                if label < 0:
+                    continue
+                disc = (xx - x) ** 2 + (yy - y) ** 2 < self.radius ** 2
+                masks[k] = masks[k] | disc if label == 1 else masks[k] & ~disc
+        return masks, np.zeros((count, 1, 256, 256), dtype=np.float32)
+
+
+def send(connection, message):
+    send_frame(connection, message.encode() if isinstance(message, str) else message)
+
+
+# Read the text reply of a command, skipping the progress counts a Modify or Undo sends before it.
+# A Modify in which tiles failed is answered "ModifyDone <count> failed", which stops the benchmark.
+def expect(connection, reply):
+    received = b""
+    while not received.endswith(reply.encode()):
+        if received.endswith(b" failed"):
+            raise RuntimeError("expected " + reply + ", got " + received.decode())
+        packet = connection.recv(4096)
+        if not packet:
+            raise ConnectionError("server closed the connection, expected " + reply)
+        received += packet
+
+
+# One scripted client session: export a view, prompt two water bodies and a box, segment, modify the terrain
+# and undo it, so the tiles are the same for the next iteration.
+def replay(connection, args, location, iteration):
+    width = args.ortho_width
+    send(connection, "OrthoWidth")
+    send(connection, str(width))
+    expect(connection, "received")
+    send(connection, "ExportImage")
+    send(connection, export_image(width, args.seed if args.same_image else args.seed + iteration))
+    expect(connection, "SetImageDone")
+    send(connection, "Points")
+    send(connection, pack_points([[width * 0.3, width * 0.4], [width * 0.35, width * 0.45], [width * 0.3, width * 0.2]],
+                                 [1, 1, 0]))
+    expect(connection, "received")
+    send(connection, "GroupEnd")
+    expect(connection, "received")
+    send(connection, "Points")
+    send(connection, pack_points([[width * 0.7, width * 0.7]], [1]))
+    expect(connection, "received")
+    send(connection, "GroupEnd")
+    expect(connection, "received")
+    send(connection, "Box")
+    send(connection, "%d %d %d %d" % (width * 0.05, width * 0.8, width * 0.25, width * 0.95))
+    expect(connection, "received")
+    send(connection, "Segment")
+    expect(connection, "SegmentDone")
+    send(connection, "ModifyBlock")
+    send(connection, pack_modify(True, args.cover, location, args.lod, args.bottom_left, [37, 91], width, tile_size))
+    expect(connection, "ModifyDone")
+    send(connection, "Undo")
+    expect(connection, "UndoDone")
+    send(connection, "Clear")
+    expect(connection, "received")
+
+
+def print_report(report, elapsed, iterations):
+    print("%-16s %6s %10s %10s %10s" % ("stage", "count", "mean ms", "max ms", "total ms"))
+    for stage, stats in report["stages"].items():
+        print("%-16s %6d %10.2f %10.2f %10.1f" % (stage, stats["count"], stats["mean_ms"], stats["max_ms"],
+                                                  stats["total_ms"]))
+    counters = report["counters"]
+    print("counters: " + ", ".join(name + " " + str(value) for name, value in counters.items()))
+    cache = report["embedding_cache"]
+    print("embedding cache: " + str(cache["hits"]) + " hits, " + str(cache["misses"]) + " misses")
+    modify = report["stages"].get("modify.total")
+    if modify:
+        tiles = counters.get("tiles_written", 0) + counters.get("tiles_skipped", 0)
+        print("modify: %.1f tiles/s" % (tiles * 1000 / modify["total_ms"]))
+    if iterations:
+        print("session: %.1f ms per iteration" % (elapsed * 1000 / iterations))
+
+
+# Replay a scripted client session against the server in this process, with the model replaced by stubs,
+# on a synthetic terrain pyramid. Prints the latency of every stage from the Stats command, so the throughput
+# of the Segment and Modify pipeline can be compared between versions without a GPU or a model checkpoint.
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1, help="iterations run before the stats are reset")
+    parser.add_argument("--ortho-width", type=int, default=1024, help="size of the exported view in pixels")
+    parser.add_argument("--lod", type=int, default=12)
+    parser.add_argument("--bottom-left", type=int, nargs=2, default=[1000, 2000])
+    parser.add_argument("--depth", type=int, default=2, help="levels below lod written by the recursive modify")
+    parser.add_argument("--vertices", type=int, default=1000, help="vertices of every synthetic tile")
+    parser.add_argument("--gzip", action="store_true", help="gzip compress the synthetic tiles")
+    parser.add_argument("--mbtiles", action="store_true", help="store the pyramid in an MBTiles file")
+    parser.add_argument("--cover", choices=("Cover", "Fill"), default="Cover")
+    parser.add_argument("--workers", type=int, default=main.default_workers)
+    parser.add_argument("--encode-ms", type=float, default=0, help="time the stub encoder takes per image")
+    parser.add_argument("--decode-ms", type=float, default=0, help="time the stub decoder takes per batch")
+    parser.add_argument("--same-image", action="store_true",
+                        help="export the same view every iteration, so the embedding cache hits")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--dir", default=None, help="directory the pyramid is built in, a temporary one if not given")
+    parser.add_argument("--json", action="store_true", help="print the Stats reply as JSON instead of a table")
+    parser.add_argument("--metrics-log", default=None, help="also write every timed stage there as a JSON line")
+    parser.add_argument("--verbose", action="store_true", help="keep the output of the server")
+    args = parser.parse_args()
+
+    work_dir = args.dir or tempfile.mkdtemp(prefix="watermodifier-benchmark-")
+    os.makedirs(work_dir, exist_ok=True)
+    location = os.path.join(work_dir, "terrain.mbtiles" if args.mbtiles else "terrain")
+    span = args.ortho_width // tile_size + 1
+    start = time.perf_counter()
+    count = build_pyramid(location, args.lod, args.bottom_left, span, args.depth, args.vertices, args.gzip,
+                          args.seed)
+    print("%d tiles built in %.1f s at %s" % (count, time.perf_counter() - start, location))
+
+    main.args = main.build_parser().parse_args(["--workers", str(args.workers)])
+    if args.metrics_log:
+        metrics.open_log(os.path.abspath(args.metrics_log))
+    main.embedding_cache = EmbeddingCache("stub")
+    main.new_predictor = lambda: StubPredictor(args.encode_ms)
+    main.decoder = StubDecoder(args.ortho_width // 8, args.decode_ms)
+    main.model_status = "Ready"
+    main.model_loaded.set()
+
+    # Segment saves mask.png in the working directory.
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    client, server = socket.socketpair()
+    thread = threading.Thread(target=main.handle_connection, args=(server, "benchmark"), daemon=True)
+    try:
+        with open(os.devnull, "w") as devnull, \
+                contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(devnull):
+            thread.start()
+            for iteration in range(args.warmup):
+                replay(client, args, location, iteration)
+            metrics.reset()
+            main.embedding_cache.hits = main.embedding_cache.misses = 0
+            start = time.perf_counter()
+            for iteration in range(args.iterations):
+                replay(client, args, location, args.warmup + iteration)
+            elapsed = time.perf_counter() - start
+            send(client, "Stats")
+            report = json.loads(recv_bytes(client))
+    finally:
+        client.close()
+        thread.join()
+        os.chdir(cwd)
+        if args.dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report, elapsed, args.iterations)
@@ -0,0 +1,124 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict, namedtuple
+
+Embedding = namedtuple("Embedding", ["features", "original_size", "input_size"])
+
+
+# Put an embedding into a predictor as if predictor.set_image() had computed it.
+def restore_embedding(predictor, embedding):
+    predictor.reset_image()
+    predictor.original_size = embedding.original_size
+    predictor.input_size = embedding.input_size
+    predictor.features = embedding.features.to(predictor.device)
+    predictor.is_image_set = True
+
+
+# Cache of SAM image embeddings keyed by the content of the image handed to the predictor.
+# Recent embeddings are kept in memory, least recently used first out. With a cache_dir they are also
+# stored as .pt files there, and the oldest files are removed once the directory grows past max_disk_mb.
+# torch is imported only when a file is read or written, so creating the cache does not load it.
+class EmbeddingCache:
+    def __init__(self, model_type, max_entries=8, cache_dir=None, max_disk_mb=1024):
+        self.model_type = model_type
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_mb * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, image):
+        digest = hashlib.sha1()
+        digest.update(self.model_type.encode())
+        digest.update(str(image.shape).encode())
+        digest.update(image.tobytes())
+        return digest.hexdigest()
+
+    # Same as predictor.set_image(image), but restores the features from the cache when the image was seen before.
+    def set_image(self, predictor, image):
+        key = self.key(image)
+        embedding = self.get(key)
+        if embedding is None:
+            predictor.set_image(image)
+            self.put(key, Embedding(predictor.features, predictor.original_size, predictor.input_size))
+            with self._lock:
+                self.misses += 1
+            print("embedding cache miss, hits: " + str(self.hits) + ", misses: " + str(self.misses))
+            return
+        restore_embedding(predictor, embedding)
+        with self._lock:
+            self.hits += 1
+        print("embedding cache hit, hits: " + str(self.hits) + ", misses: " + str(self.misses))
+
+    def get(self, key):
+        with self._lock:
+            embedding = self._entries.get(key)
+            if embedding is not None:
+                self._entries.move_to_end(key)
+                return embedding
+        embedding = self._load(key)
+        if embedding is not None:
+            self._remember(key, embedding)
+        return embedding
+
+    def put(self, key, embedding):
+        self._remember(key, embedding)
+        self._store(key, embedding)
+
+    def _remember(self, key, embedding):
+        with self._lock:
+            self._entries[key] = embedding
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".pt")
+
+    def _load(self, key):
+        if self.cache_dir is None or not os.path.exists(self._path(key)):
+            return None
+        import torch
+
+        try:
+            data = torch.load(self._path(key), map_location="cpu")
+        except Exception as e:
+            print("embedding cache: cannot load " + self._path(key) + ": " + repr(e))
+            return None
+        os.utime(self._path(key))
+        return Embedding(data["features"], tuple(data["original_size"]), tuple(data["input_size"]))
+
+    def _store(self, key, embedding):
+        if self.cache_dir is None:
+            return
+        import torch
+
+        temp_path = self._path(key) + ".tmp"
+        torch.save({
+            "features": embedding.features.detach().cpu(),
+            "original_size": embedding.original_size,
+            "input_size": embedding.input_size,
+        }, temp_path)
+        os.replace(temp_path, self._path(key))
+        self._trim()
+
+    # Remove the least recently used files until the directory fits in max_disk_bytes.
+    def _trim(self):
+        with self._lock:
+            files = []
+            for entry in os.scandir(self.cache_dir):
+                if entry.name.endswith(".pt"):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+            files.sort()
+            total = sum(size for mtime, size, path in files)
+            for mtime, size, path in files:
+                if total <= self.max_disk_bytes:
+                    break
+                os.remove(path)
+                total -= size
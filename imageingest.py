@@ -0,0 +1,52 @@
+import threading
+
+import cv2
+import numpy as np
+
+gamma = 1.0 / 2.2
+
+
+# Tone mapping of exported views to the 8-bit RGB image the encoder takes.
+# HDR data is made finite and non-negative (NaN and -inf to 0, +inf to 1), normalized to [0, 1] over all channels,
+# gamma corrected and truncated to 8 bits, all in one float buffer that is reused while the export size stays the
+# same. 8-bit images are only converted to RGB.
+# The returned image is a reused buffer as well: it stays valid until the next image goes through the same ingest.
+class ImageIngest:
+    def __init__(self):
+        self._float = None
+        self._image = None
+        self._lock = threading.Lock()
+
+    def _buffers(self, shape):
+        if self._image is None or self._image.shape[:2] != shape:
+            self._float = np.empty(shape + (3,), dtype=np.float32)
+            self._image = np.empty(shape + (3,), dtype=np.uint8)
+        return self._float, self._image
+
+    def tone_map(self, img):
+        if img is None:
+            raise ValueError("Failed to load image. Check the file path and format.")
+        channels = 1 if img.ndim == 2 else img.shape[2]
+        code = {1: cv2.COLOR_GRAY2RGB, 3: cv2.COLOR_BGR2RGB, 4: cv2.COLOR_BGRA2RGB}[channels]
+        with self._lock:
+            buffer, image = self._buffers(img.shape[:2])
+            if img.dtype == np.uint8:
+                return cv2.cvtColor(img, code, dst=image)
+            cv2.cvtColor(img.astype(np.float32, copy=False), code, dst=buffer)
+            np.fmax(buffer, 0, out=buffer)
+            if np.isinf(buffer.max()):
+                np.putmask(buffer, buffer == np.inf, 1)
+            cv2.normalize(buffer, buffer, 0, 1, cv2.NORM_MINMAX)
+            # Rounding can leave the minimum slightly below 0, which would turn into NaN below.
+            np.fmax(buffer, 0, out=buffer)
+            np.power(buffer, gamma, out=buffer)
+            np.multiply(buffer, 255, out=buffer)
+            np.copyto(image, buffer, casting='unsafe')
+            return image
+
+    def read(self, path):
+        return self.tone_map(cv2.imread(path, cv2.IMREAD_UNCHANGED))
+
+    # Image sent as the bytes of an encoded file, EXR or any other format cv2 reads.
+    def decode(self, data):
+        return self.tone_map(cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED))
@@ -1,177 +1,582 @@
+import argparse
+import itertools
+import json
+import os
+import socket
 import subprocess
-import sys
-
-import torch
-from matplotlib import pyplot as plt
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
+# Must be set before cv2 is first imported, which tilemodifier does.
+os.environ["OPENCV_IO_ENABLE_OPENEXR"] = "1"
 from tilemodifier import *
 
-os.environ["OPENCV_IO_ENABLE_OPENEXR"] = "1"
 import cv2
 import numpy as np
 
-from segment_anything import sam_model_registry, SamPredictor
+import terrainstore
+from embeddingcache import EmbeddingCache
+from imageingest import ImageIngest
+from metrics import metrics
+from tiledsegment import ImageWindows, default_window_overlap, window_size
+from protocol import *
 
 sam_checkpoint = "./models/sam_vit_b_01ec64.pth"
 model_type = "vit_b"
 
-device = "cuda:0" if torch.cuda.is_available() else "cpu"
-
-def get_image():
-    img = cv2.imread('./out.exr', cv2.IMREAD_UNCHANGED)
-    if img is None:
-        raise ValueError("Failed to load image. Check the file path and format.")
-    img = img[:, :, :3]
-    img = np.nan_to_num(img, nan=0.0, posinf=1.0, neginf=0.0)  # 将 NaN/Inf 替换为合理值
-    img = np.maximum(img, 0)  # 确保没有负数
-    img = cv2.normalize(img, None, 0, 1, cv2.NORM_MINMAX)
-    img = np.power(img, 1.0 / 2.2)
-    img = (img * 255).astype(np.uint8)
-    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-    predictor.set_image(img)
-    return img
-
-
-def segment(input_point, input_label, ortho_width):
-    mask, _, _ = predictor.predict(
-        point_coords=input_point,
-        point_labels=input_label,
-        multimask_output=False,
-    )
-    return mask.reshape(ortho_width, ortho_width)
-
-
-def save_mask(mask):
-    color = np.array([255 / 255, 255 / 255, 255 / 255, 0.5])
+# Number of modifications per session that can be undone.
+max_undo = 16
+
+# The model loads in the background while the server already accepts clients. torch and segment_anything are
+# only imported there, as they take most of the startup time.
+sam = None
+device = None
+# Exported mask decoder used instead of the torch one, see onnxdecoder.py.
+decoder = None
+model_status = "Loading"
+model_loaded = threading.Event()
+
+
+def load_model():
+    global sam, device, decoder, model_status
+    try:
+        import torch
+        from saminference import build_sam, configure_threads
+
+        configure_threads(args.torch_threads, args.torch_interop_threads)
+        device = "cuda:0" if torch.cuda.is_available() else "cpu"
+        sam = build_sam(model_type, sam_checkpoint, device, args.encoder_precision)
+        if args.onnx_decoder:
+            from onnxdecoder import load_decoder
+            decoder = load_decoder(sam, args.onnx_decoder)
+        warm_up()
+        model_status = "Ready"
+    except Exception as e:
+        sam = None
+        model_status = "Failed " + repr(e)
+    finally:
+        print("model " + model_status)
+        model_loaded.set()
+
+
+# Wait until the model is loaded and return it.
+def wait_for_model():
+    model_loaded.wait()
+    if sam is None:
+        raise RuntimeError("model not available: " + model_status)
+    return sam
+
+
+# Predictor of a new session, over the shared model. benchmark_pipeline.py replaces it with a stub.
+def new_predictor():
+    from segment_anything import SamPredictor
+
+    return SamPredictor(wait_for_model())
+
+
+# Run the encoder and decoder once on a small image, so the first Segment does not pay for their initialization.
+def warm_up():
+    from segment_anything import SamPredictor
+
+    predictor = SamPredictor(sam)
+    predictor.set_image(np.zeros((64, 64, 3), dtype=np.uint8))
+    group = PromptGroup()
+    group.add_point([32, 32], 1)
+    predict_groups(predictor, [group], False, False)
+
+
+# All model inference runs on this single worker, so sessions share one model without running it concurrently.
+inference_queue = ThreadPoolExecutor(max_workers=1)
+
+
+def run_inference(function, *args, **kwargs):
+    return inference_queue.submit(function, *args, **kwargs).result()
+
+
+# Points, labels and optional box of one water body. Its mask and low resolution logits are kept from the last
+# Segment: the mask is reused while the prompts stay the same, and the logits refine the next one once they change.
+class PromptGroup:
+    def __init__(self):
+        self.points = []
+        self.labels = []
+        self.box = None
+        self.mask = None
+        self.logits = None
+        # Logits of every image window the group was decoded in, when the view is split into windows.
+        self.window_logits = {}
+        self.changed = False
+
+    def add_point(self, point, label):
+        self.points.append(point)
+        self.labels.append(label)
+        self.changed = True
+
+    def set_box(self, box):
+        self.box = box
+        self.changed = True
+
+    def empty(self):
+        return not self.points and self.box is None
+
+
+# Key of the decoder batch a group goes to. predict_torch takes a box and previous logits for the whole batch or
+# not at all, and the groups of a batch need the same number of points: padding with label -1 would not be
+# ignored, as the prompt encoder turns each such point into a not-a-point token the decoder still attends to,
+# and a group's mask would depend on the other groups of its batch.
+def batch_key(group):
+    return group.box is not None, group.logits is not None, len(group.points)
+
+
+# Decode the masks of a batch of prompt groups sharing a batch_key() in one pass of the decoder against the
+# current embedding, so each mask is the one a predict call for that group alone would give.
+# Returns the (B, H, W) masks and the (B, 1, 256, 256) low resolution logits.
+def predict_groups(predictor, groups, has_box, has_logits):
+    point_coords = point_labels = boxes = mask_input = None
+    if groups[0].points:
+        coords = np.array([group.points for group in groups], dtype=np.float32)
+        point_coords = predictor.transform.apply_coords(coords, predictor.original_size)
+        point_labels = np.array([group.labels for group in groups], dtype=np.int32)
+    if has_box:
+        boxes = predictor.transform.apply_boxes(np.array([group.box for group in groups], dtype=np.float32),
+                                                predictor.original_size)
+    if has_logits:
+        mask_input = np.stack([group.logits for group in groups])
+    if decoder is not None:
+        return decoder.predict(predictor, point_coords, point_labels, boxes, mask_input)
+
+    import torch
+
+    if point_coords is not None:
+        point_coords = torch.as_tensor(point_coords, dtype=torch.float, device=predictor.device)
+        point_labels = torch.as_tensor(point_labels, dtype=torch.int, device=predictor.device)
+    if boxes is not None:
+        boxes = torch.as_tensor(boxes, dtype=torch.float, device=predictor.device)
+    if mask_input is not None:
+        mask_input = torch.as_tensor(mask_input, dtype=torch.float, device=predictor.device)
+    masks, _, logits = predictor.predict_torch(point_coords, point_labels, boxes, mask_input, multimask_output=False)
+    return masks[:, 0].cpu().numpy(), logits.cpu().numpy()
+
+
+# Segment every prompt group and return the union of their masks.
+# Only groups whose prompts changed since the last Segment are decoded, batched by batch_key().
+def segment(predictor, groups, ortho_width):
+    batches = {}
+    for group in groups:
+        if group.changed and not group.empty():
+            batches.setdefault(batch_key(group), []).append(group)
+    for (has_box, has_logits, count), batch in batches.items():
+        with metrics.timer("segment.decode", groups=len(batch)):
+            masks, logits = run_inference(predict_groups, predictor, batch, has_box, has_logits)
+        for group, mask, group_logits in zip(batch, masks, logits):
+            group.mask = mask.reshape(ortho_width, ortho_width)
+            group.logits = group_logits
+            group.changed = False
+    mask = np.zeros((ortho_width, ortho_width), dtype=bool)
+    for group in groups:
+        if group.mask is not None:
+            mask |= group.mask
+    return mask
+
+
+# The prompts of a group that fall in one image window, in window coordinates, with the logits the group last had
+# there. None when the window holds neither a positive point nor part of the box, as there is nothing to find then.
+def window_group(group, bounds, index):
+    y0, x0, y1, x1 = bounds
+    local = PromptGroup()
+    for (x, y), label in zip(group.points, group.labels):
+        if x0 <= x < x1 and y0 <= y < y1:
+            local.add_point([x - x0, y - y0], label)
+    if group.box is not None:
+        box_x0, box_y0, box_x1, box_y1 = group.box
+        if box_x0 < x1 and x0 <= box_x1 and box_y0 < y1 and y0 <= box_y1:
+            local.set_box([max(box_x0, x0) - x0, max(box_y0, y0) - y0, min(box_x1, x1) - x0, min(box_y1, y1) - y0])
+    if local.box is None and 1 not in local.labels:
+        return None
+    local.logits = group.window_logits.get(index)
+    return local
+
+
+def predict_window(predictor, windows, index, groups, has_box, has_logits):
+    windows.restore(predictor, index)
+    return predict_groups(predictor, groups, has_box, has_logits)
+
+
+# Segment the prompt groups of a view split into ImageWindows and return the union of their masks.
+# A changed group is decoded in every window its prompts fall in, and the groups sharing a window are decoded there
+# in as few batches as segment() would use. The window masks of a group are blended by a vote weighted by
+# windows.weights(), so where windows overlap the one further from its border decides.
+def segment_windows(predictor, windows, groups, ortho_width):
+    routed = {}
+    votes = {}
+    for group in groups:
+        if not group.changed or group.empty():
+            continue
+        votes[group] = (np.zeros(windows.shape, dtype=np.float32), np.zeros(windows.shape, dtype=np.float32))
+        for index in windows.touching(group.points, group.box):
+            local = window_group(group, windows.bounds[index], index)
+            if local is not None:
+                routed.setdefault(index, []).append((group, local))
+    for index, pairs in sorted(routed.items()):
+        batches = {}
+        for group, local in pairs:
+            batches.setdefault(batch_key(local), []).append((group, local))
+        y0, x0, y1, x1 = windows.bounds[index]
+        weights = windows.weights(index)
+        for (has_box, has_logits, count), batch in batches.items():
+            with metrics.timer("segment.decode", groups=len(batch), window=index):
+                masks, logits = run_inference(predict_window, predictor, windows, index,
+                                              [local for group, local in batch], has_box, has_logits)
+            for (group, local), mask, group_logits in zip(batch, masks, logits):
+                group.window_logits[index] = group_logits
+                weighted, total = votes[group]
+                weighted[y0:y1, x0:x1] += weights * mask
+                total[y0:y1, x0:x1] += weights
+    for group, (weighted, total) in votes.items():
+        group.mask = (weighted * 2 > total).reshape(ortho_width, ortho_width)
+        group.changed = False
+    mask = np.zeros((ortho_width, ortho_width), dtype=bool)
+    for group in groups:
+        if group.mask is not None:
+            mask |= group.mask
+    return mask
+
+
+# Water is written as white at half opacity over a transparent background.
+mask_color = np.array([255, 255, 255, 127], dtype=np.uint8)
+
+
+def save_mask(mask, path):
     h, w = mask.shape[-2:]
-    mask_image = mask.reshape(h, w, 1) * color.reshape(1, 1, -1)
-    plt.imsave("./mask.png", mask_image)
+    mask_image = np.zeros((h, w, 4), dtype=np.uint8)
+    mask_image[mask.reshape(h, w)] = mask_color
+    with metrics.timer("mask.save"):
+        cv2.imwrite(path, mask_image)
 
 
-import socket
+# The frontend reads the mask of a Segment from default_mask_path. One connected session at a time writes it there;
+# the others each write their own mask_<session number>.png and name that file in their SegmentDone reply,
+# so concurrent clients neither see each other's masks nor write the same file.
+default_mask_path = "./mask.png"
+default_mask_owner = None
+mask_path_lock = threading.Lock()
+session_numbers = itertools.count(1)
+
+
+def acquire_mask_path(session):
+    global default_mask_owner
+    with mask_path_lock:
+        if default_mask_owner is None:
+            default_mask_owner = session
+            return default_mask_path
+    return "./mask_" + str(session.number) + ".png"
 
-with open("./port.txt",'r') as f:
-    port = int(f.read().strip())
 
-s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-s.bind(("", port))
-s.listen(1)
+def release_mask_path(session):
+    global default_mask_owner
+    with mask_path_lock:
+        if default_mask_owner is session:
+            default_mask_owner = None
 
-def recv_all(sock, n):
-    data = b''
-    while len(data) < n:
-        packet = sock.recv(n-len(data))
-        if not packet:
+
+# State of one connected client. The predictor holds this session's image embedding,
+# while the model behind it is shared by every session.
+class Session:
+    def __init__(self, connection, address):
+        self.connection = connection
+        self.address = address
+        self.number = next(session_numbers)
+        self.mask_path = acquire_mask_path(self)
+        self._predictor = None
+        self.ingest = ImageIngest()
+        self.image = None
+        # ImageWindows of the view when it is encoded in windows, None when it is encoded whole.
+        self.windows = None
+        self.ortho_width = None
+        self.mask = None
+        self.journals = []
+        self.clear_prompts()
+
+    # Created on first use, which waits for the model to be loaded.
+    @property
+    def predictor(self):
+        if self._predictor is None:
+            self._predictor = new_predictor()
+        return self._predictor
+
+    def clear_prompts(self):
+        self.prompt_groups = [PromptGroup()]
+        self.pen_strokes = [[]]
+
+    # Group the next points and box go to.
+    def prompt_group(self):
+        return self.prompt_groups[-1]
+
+    # Masks and logits from the previous image no longer apply.
+    def forget_masks(self):
+        for group in self.prompt_groups:
+            group.mask = None
+            group.logits = None
+            group.window_logits = {}
+            group.changed = True
+
+    # Encode an exported view, split into windows when tiled encoding is on and the view is larger than one window.
+    def set_image(self, image):
+        self.image = image
+        self.windows = None
+        predictor = self.predictor
+        with metrics.timer("image.encode", width=image.shape[1], height=image.shape[0]):
+            if args.tiled_encoding and max(image.shape[:2]) > window_size:
+                self.windows = ImageWindows(image.shape, args.window_overlap)
+                run_inference(self.windows.encode, predictor, image, embedding_cache)
+            else:
+                run_inference(embedding_cache.set_image, predictor, image)
+        self.forget_masks()
+
+    # Apply the current mask to the terrain, keeping a journal to undo it.
+    # Returns the (name, error) of the tiles that could not be modified.
+    def modify(self, recursive, cover, terrain_folder_path, lod, bottom_left, offset, orthowidth_and_tilesize):
+        journal = ModifyJournal()
+        modify = modify_tiles if recursive else modify_without_recursive
+        errors = modify(self.mask, terrain_folder_path, lod, bottom_left, offset, orthowidth_and_tilesize,
+                        self.connection, cover, args.workers, journal)
+        self.journals.append(journal)
+        del self.journals[:-max_undo]
+        return errors
+
+    # Undo the last modification. Returns the tiles that could not be restored, or None if there is nothing to undo.
+    # A journal with such tiles stays on top, so the next Undo retries them.
+    def undo(self):
+        if not self.journals:
             return None
-        data += packet
-    return data
+        errors = undo_modify(self.journals[-1], self.connection, args.workers)
+        if not errors:
+            self.journals.pop()
+        return errors
 
-def recv_len(sock):
-    raw_bytes = recv_all(sock,4)
-    if raw_bytes is None:
-        return None
-    if len(raw_bytes) != 4:
-        return None
-    int_value = struct.unpack("<i",raw_bytes)[0]
-    return int_value
 
-def recv_msg(sock):
-    msg_length = recv_len(sock)
-    if msg_length is None:
-        return None
-    raw_msg = recv_all(sock, msg_length)
-    if raw_msg is None:
-        return None
-    return raw_msg.decode()
+# Cover mode, terrain folder path, lod, bottom left tile, offset and "ortho_width tile_size" of a Modify.
+def recv_modify_params(connection):
+    cover = recv_msg(connection)
+    terrain_folder_path = recv_msg(connection)
+    lod = recv_msg(connection)
+    bottom_left = recv_msg(connection).split(" ")
+    offset = recv_msg(connection).split(" ")
+    orthowidth_and_tilesize = recv_msg(connection).split(" ")
+    return cover, terrain_folder_path, lod, bottom_left, offset, orthowidth_and_tilesize
+
+
+# "x0 y0 x1 y1" corners of a box prompt.
+def recv_box(connection):
+    return [float(coord) for coord in recv_msg(connection).split(" ")]
+
+
+def recv_dot(connection):
+    dot = recv_msg(connection)
+    coords = dot.split(" ")
+    coords[0] = float(coords[0])
+    coords[1] = float(coords[1])
+    return coords
+
+
+# Latency of every stage so far, the counters and the embedding cache hits, see metrics.py.
+def stats():
+    report = metrics.snapshot()
+    report["model"] = model_status
+    report["embedding_cache"] = {"hits": embedding_cache.hits, "misses": embedding_cache.misses}
+    return report
+
+
+# Serve one client until it disconnects. Runs on its own thread.
+def handle_connection(connection, address):
+    print("Connected by:", address)
+    session = Session(connection, address)
+    try:
+        while True:
+            data = recv_msg(connection)
+            if data is None:
+                break
+            content = ""
+            if data == "OrthoWidth":
+                ortho_width = recv_msg(connection)
+                session.ortho_width = int(ortho_width)
+                print(session.ortho_width)
+                session.mask = np.zeros(shape=(session.ortho_width, session.ortho_width), dtype=bool)
+            elif data == "PositiveDot":
+                session.prompt_group().add_point(recv_dot(connection), 1)
+            elif data == "NegativeDot":
+                session.prompt_group().add_point(recv_dot(connection), 0)
+            elif data == "Box":
+                session.prompt_group().set_box(recv_box(connection))
+            elif data == "GroupEnd":
+                # Following dots and boxes prompt another water body.
+                if not session.prompt_group().empty():
+                    session.prompt_groups.append(PromptGroup())
+            elif data == "PenDot":
+                session.pen_strokes[-1].append(recv_dot(connection))
+            elif data == "PenEnd":
+                # Following pen dots start another polygon.
+                if session.pen_strokes[-1]:
+                    session.pen_strokes.append([])
+            elif data == "Status":
+                content = "Model " + model_status
+            elif data == "Protocol":
+                content = "Protocol " + str(negotiate(recv_msg(connection)))
+            elif data == "Points":
+                points, labels = unpack_points(recv_bytes(connection))
+                for point, label in zip(points.tolist(), labels.tolist()):
+                    session.prompt_group().add_point(point, label)
+            elif data == "PenStroke":
+                stroke = unpack_pen_stroke(recv_bytes(connection))
+                if session.pen_strokes[-1]:
+                    session.pen_strokes.append([])
+                session.pen_strokes[-1].extend(stroke.tolist())
+                session.pen_strokes.append([])
+            elif data == "Segment":
+                pen_polygons = [np.array(stroke) for stroke in session.pen_strokes if stroke]
+                with metrics.timer("segment.total", groups=len(session.prompt_groups), pen=len(pen_polygons)):
+                    if any(not group.empty() for group in session.prompt_groups):
+                        if session.windows is not None:
+                            session.mask = segment_windows(session.predictor, session.windows,
+                                                           session.prompt_groups, session.ortho_width)
+                        else:
+                            session.mask = segment(session.predictor, session.prompt_groups, session.ortho_width)
+                    if pen_polygons:
+                        with metrics.timer("segment.pen", polygons=len(pen_polygons)):
+                            session.mask = pen_process(pen_polygons, session.mask)
+                    save_mask(session.mask, session.mask_path)
+                content = "SegmentDone"
+                if session.mask_path != default_mask_path:
+                    content += " " + session.mask_path
+            elif data == "Modify" or data == "ModifyWithoutRecursive" or data == "ModifyBlock":
+                if data == "ModifyBlock":
+                    params = unpack_modify(recv_bytes(connection))
+                else:
+                    params = (data == "Modify",) + recv_modify_params(connection)
+                try:
+                    errors = session.modify(*params)
+                    # The other tiles are written even when some fail; the reply says how many did.
+                    content = "ModifyDone " + str(len(errors)) + " failed" if errors else "ModifyDone"
+                except (FileNotFoundError, ValueError) as e:
+                    # The tileset could not be opened, nothing was written.
+                    content = "ModifyFailed " + str(e)
+            elif data == "ModifyDryRun" or data == "ModifyDryRunWithoutRecursive":
+                # Answered with a JSON frame listing the tiles that would change. No progress counts are sent
+                # before it, as they are not framed and the client could not find where the frame starts.
+                cover, terrain_folder_path, lod, bottom_left, offset, orthowidth_and_tilesize = \
+                    recv_modify_params(connection)
+                try:
+                    changes, errors = stage_modify(session.mask, terrain_folder_path, lod, bottom_left, offset,
+                                                   orthowidth_and_tilesize, None, cover,
+                                                   data == "ModifyDryRun", args.workers)
+                except (FileNotFoundError, ValueError) as e:
+                    changes, errors = [], [(terrain_folder_path, e)]
+                report = {
+                    "tiles": [{"path": path, "changed_pixels": pixels} for path, pixels in changes if pixels],
+                    "unchanged": sum(1 for path, pixels in changes if not pixels),
+                    "errors": [{"path": path, "error": repr(error)} for path, error in errors],
+                }
+                send_frame(connection, json.dumps(report).encode())
+                continue
+            elif data == "Undo":
+                errors = session.undo()
+                if errors is None:
+                    content = "NothingToUndo"
+                elif errors:
+                    content = "UndoFailed " + str(len(errors))
+                else:
+                    content = "UndoDone"
+            elif data == "Stats":
+                # Answered with a JSON frame, see stats().
+                send_frame(connection, json.dumps(stats()).encode())
+                continue
+            elif data == "GetMask":
+                # Answered with a binary frame instead of a text reply.
+                encoding = unpack_mask_request(recv_bytes(connection))
+                send_frame(connection, pack_mask(session.mask, encoding))
+                continue
+            elif data == "ExportDone":
+                with metrics.timer("image.ingest"):
+                    image = session.ingest.read(args.export_path)
+                session.set_image(image)
+                content = "SetImageDone"
+            elif data == "ExportImage":
+                # The exported view itself, as the bytes of an EXR or other image file.
+                payload = recv_bytes(connection)
+                with metrics.timer("image.ingest", size=len(payload)):
+                    image = session.ingest.decode(payload)
+                session.set_image(image)
+                content = "SetImageDone"
+            elif data == "Clear":
+                session.image = None
+                session.windows = None
+                session.mask = np.zeros(shape=(session.ortho_width, session.ortho_width), dtype=bool)
+                session.clear_prompts()
+                if session._predictor is not None:
+                    session.predictor.reset_image()
+
+            if content == "":
+                content = "received"
+            connection.sendall(content.encode())
+    except (ConnectionAbortedError, ConnectionResetError, BrokenPipeError):
+        print("Connection aborted:", address)
+    except Exception as e:
+        print("Session", address, "failed:", repr(e))
+    finally:
+        release_mask_path(session)
+        connection.close()
+        print("Disconnected:", address)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=default_workers,
+                        help="number of tiles modified in parallel")
+    parser.add_argument("--embedding-cache-size", type=int, default=8,
+                        help="number of image embeddings kept in memory")
+    parser.add_argument("--embedding-cache-dir", default=None,
+                        help="directory where image embeddings are also stored on disk")
+    parser.add_argument("--embedding-cache-disk-mb", type=int, default=1024,
+                        help="size limit of the on-disk embedding cache")
+    parser.add_argument("--torch-threads", type=int, default=None,
+                        help="threads torch uses within one operation, the torch default if not given")
+    parser.add_argument("--torch-interop-threads", type=int, default=None,
+                        help="threads torch uses across independent operations, the torch default if not given")
+    parser.add_argument("--encoder-precision", choices=("fp32", "int8", "bf16"), default="fp32",
+                        help="precision of the image encoder, see benchmark_encoder.py for the trade-off")
+    parser.add_argument("--export-path", default="./out.exr",
+                        help="image the frontend exports the view to before sending ExportDone")
+    parser.add_argument("--tiled-encoding", action="store_true",
+                        help="encode views larger than " + str(window_size) + " pixels in overlapping windows at full "
+                             "resolution instead of downscaling them")
+    parser.add_argument("--window-overlap", type=int, default=default_window_overlap,
+                        help="pixels shared by neighbouring windows in tiled encoding")
+    parser.add_argument("--onnx-decoder", default=None,
+                        help="run the mask decoder with onnxruntime from this ONNX file, exported first if missing")
+    parser.add_argument("--gzip-level", type=int, default=terrainstore.gzip_level,
+                        help="compression level of gzip compressed terrain tiles that are written back")
+    parser.add_argument("--metrics-log", default=None,
+                        help="file the latency of every stage is appended to as JSON lines, - for stdout")
+    return parser
+
 
 if __name__ == '__main__':
+    args = build_parser().parse_args()
+    if args.metrics_log:
+        metrics.open_log(args.metrics_log)
+    terrainstore.gzip_level = args.gzip_level
     #subprocess.Popen(["./WaterModifier-Win64-Shipping.exe"])
-    sam = sam_model_registry[model_type](checkpoint=sam_checkpoint)
-    sam.to(device=device)
-    predictor = SamPredictor(sam)
-    image = None
-    ortho_width = None
-    mask = None
+    threading.Thread(target=load_model, daemon=True).start()
+    # Embeddings of a reduced precision encoder are cached apart from the fp32 ones.
+    embedding_model = model_type if args.encoder_precision == "fp32" else model_type + "_" + args.encoder_precision
+    embedding_cache = EmbeddingCache(embedding_model, args.embedding_cache_size, args.embedding_cache_dir,
+                                     args.embedding_cache_disk_mb)
+
+    with open("./port.txt",'r') as f:
+        port = int(f.read().strip())
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("", port))
+    s.listen()
     while True:
         connection, address = s.accept()
-        print("Connected by:", address)
-        input_points = []
-        input_labels = []
-        pen_points = []
-        try:
-            while True:
-                data = recv_msg(connection)
-                content = ""
-                if data == "OrthoWidth":
-                    ortho_width = recv_msg(connection)
-                    ortho_width = int(ortho_width)
-                    print(ortho_width)
-                    mask = np.zeros(shape=(ortho_width,ortho_width), dtype=bool)
-                elif data == "PositiveDot":
-                    dot = recv_msg(connection)
-                    coords = dot.split(" ")
-                    coords[0] = float(coords[0])
-                    coords[1] = float(coords[1])
-                    input_points.append(coords)
-                    input_labels.append(1)
-                elif data == "NegativeDot":
-                    dot = recv_msg(connection)
-                    coords = dot.split(" ")
-                    coords[0] = float(coords[0])
-                    coords[1] = float(coords[1])
-                    input_points.append(coords)
-                    input_labels.append(0)
-                elif data == "PenDot":
-                    dot = recv_msg(connection)
-                    coords = dot.split(" ")
-                    coords[0] = float(coords[0])
-                    coords[1] = float(coords[1])
-                    pen_points.append(coords)
-                elif data == "Segment":
-                    input_points_array = np.array(input_points)
-                    input_labels_array = np.array(input_labels)
-                    pen_points_array = np.array(pen_points)
-                    if len(input_points_array):
-                        mask = segment(input_points_array, input_labels_array, ortho_width)
-                    if len(pen_points_array):
-                        mask = pen_process(pen_points_array, mask)
-                    save_mask(mask)
-                    content = "SegmentDone"
-                elif data == "Modify":
-                    cover = recv_msg(connection)
-                    terrain_folder_path = recv_msg(connection)
-                    lod = recv_msg(connection)
-                    bottom_left = recv_msg(connection).split(" ")
-                    offset = recv_msg(connection).split(" ")
-                    orthowidth_and_tilesize = recv_msg(connection).split(" ")
-                    array = analyse_mask(mask.tolist())
-                    modify_tiles(array, terrain_folder_path, lod, bottom_left, offset, orthowidth_and_tilesize, connection, cover)
-                    content = "ModifyDone"
-                elif data == "ModifyWithoutRecursive":
-                    cover = recv_msg(connection)
-                    terrain_folder_path = recv_msg(connection)
-                    lod = recv_msg(connection)
-                    bottom_left = recv_msg(connection).split(" ")
-                    offset = recv_msg(connection).split(" ")
-                    orthowidth_and_tilesize = recv_msg(connection).split(" ")
-                    array = analyse_mask(mask.tolist())
-                    modify_without_recursive(array, terrain_folder_path, lod, bottom_left, offset, orthowidth_and_tilesize, connection, cover)
-                    content = "ModifyDone"
-                elif data == "ExportDone":
-                    image = get_image()
-                    content = "SetImageDone"
-                elif data == "Clear":
-                    image = None
-                    mask = np.zeros(shape=(ortho_width,ortho_width), dtype=bool)
-                    input_points = []
-                    input_labels = []
-                    pen_points = []
-                    predictor.reset_image()
-
-                if content == "":
-                    content = "received"
-                connection.sendall(content.encode())
-        except ConnectionAbortedError:
-            print("Connection aborted")
-            connection.close()
-            sys.exit(0)
\ No newline at end of file
+        threading.Thread(target=handle_connection, args=(connection, address), daemon=True).start()
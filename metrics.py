@@ -0,0 +1,67 @@
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Latency of the stages of Segment and Modify, and counters, shared by every session.
+# With a log attached, every timed stage is also written to it as one JSON line.
+class Metrics:
+    def __init__(self):
+        self._stages = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+        self._log = None
+
+    # Write one JSON line per timed stage to path, "-" for stdout.
+    def open_log(self, path):
+        self._log = sys.stdout if path == "-" else open(path, "a", buffering=1)
+
+    def record(self, stage, seconds, **fields):
+        with self._lock:
+            stats = self._stages.get(stage)
+            if stats is None:
+                stats = self._stages[stage] = [0, 0.0, 0.0, 0.0]
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+            stats[3] = seconds
+            if self._log is not None:
+                line = {"time": time.time(), "stage": stage, "ms": round(seconds * 1000, 3)}
+                line.update(fields)
+                self._log.write(json.dumps(line) + "\n")
+
+    @contextmanager
+    def timer(self, stage, **fields):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start, **fields)
+
+    def count(self, counter, n=1):
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + n
+
+    # Count, total, mean, max and last latency of every stage in milliseconds, and the counters.
+    def snapshot(self):
+        with self._lock:
+            stages = {}
+            for stage, (count, total, longest, last) in sorted(self._stages.items()):
+                stages[stage] = {
+                    "count": count,
+                    "total_ms": round(total * 1000, 3),
+                    "mean_ms": round(total * 1000 / count, 3),
+                    "max_ms": round(longest * 1000, 3),
+                    "last_ms": round(last * 1000, 3),
+                }
+            return {"stages": stages, "counters": dict(sorted(self._counters.items()))}
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+            self._counters.clear()
+
+
+metrics = Metrics()
@@ -0,0 +1,88 @@
+import os
+
+import numpy as np
+import onnxruntime
+
+onnx_opset = 17
+
+
+# Export the prompt encoder and mask decoder of a SAM model to an ONNX file.
+# Batch size and number of points are dynamic, and all four mask outputs are kept so the caller can take the
+# first one, which is what the decoder returns with multimask_output=False.
+def export_decoder(sam, path):
+    import torch
+    from segment_anything.utils.onnx import SamOnnxModel
+
+    onnx_model = SamOnnxModel(sam, return_single_mask=False)
+    embed_dim = sam.prompt_encoder.embed_dim
+    embed_size = sam.prompt_encoder.image_embedding_size
+    mask_input_size = [4 * x for x in embed_size]
+    device = sam.device
+    dummy_inputs = {
+        "image_embeddings": torch.randn(1, embed_dim, *embed_size, dtype=torch.float, device=device),
+        "point_coords": torch.randint(low=0, high=1024, size=(1, 5, 2), dtype=torch.float, device=device),
+        "point_labels": torch.randint(low=0, high=4, size=(1, 5), dtype=torch.float, device=device),
+        "mask_input": torch.randn(1, 1, *mask_input_size, dtype=torch.float, device=device),
+        "has_mask_input": torch.tensor([1], dtype=torch.float, device=device),
+        "orig_im_size": torch.tensor([1500, 2250], dtype=torch.float, device=device),
+    }
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as file:
+        torch.onnx.export(
+            onnx_model,
+            tuple(dummy_inputs.values()),
+            file,
+            export_params=True,
+            opset_version=onnx_opset,
+            do_constant_folding=True,
+            input_names=list(dummy_inputs.keys()),
+            output_names=["masks", "iou_predictions", "low_res_masks"],
+            dynamic_axes={
+                "point_coords": {0: "batch", 1: "num_points"},
+                "point_labels": {0: "batch", 1: "num_points"},
+                "mask_input": {0: "batch"},
+            },
+        )
+    os.replace(temp_path, path)
+
+
+# SAM prompt encoder and mask decoder running as an exported ONNX graph, on CPU by default.
+# Takes the same prompts as SamPredictor.predict_torch, as numpy arrays already transformed to the input frame.
+class OnnxDecoder:
+    def __init__(self, path, providers=("CPUExecutionProvider",)):
+        self.path = path
+        self.session = onnxruntime.InferenceSession(path, providers=list(providers))
+
+    # Returns the (B, H, W) masks and the (B, 1, 256, 256) low resolution logits.
+    def predict(self, predictor, point_coords, point_labels, boxes=None, mask_input=None):
+        batch = len(point_coords) if point_coords is not None else len(boxes)
+        if point_coords is None:
+            point_coords = np.zeros((batch, 0, 2), dtype=np.float32)
+            point_labels = np.zeros((batch, 0), dtype=np.float32)
+        # Box corners are points labeled 2 and 3. Without a box the prompt encoder adds one padding point.
+        if boxes is not None:
+            corner_coords = np.asarray(boxes, dtype=np.float32).reshape(batch, 2, 2)
+            corner_labels = np.tile(np.array([2, 3], dtype=np.float32), (batch, 1))
+        else:
+            corner_coords = np.zeros((batch, 1, 2), dtype=np.float32)
+            corner_labels = np.full((batch, 1), -1, dtype=np.float32)
+        has_mask_input = np.array([0 if mask_input is None else 1], dtype=np.float32)
+        if mask_input is None:
+            mask_input = np.zeros((batch, 1, 256, 256), dtype=np.float32)
+        masks, _, logits = self.session.run(None, {
+            "image_embeddings": predictor.features.detach().cpu().numpy(),
+            "point_coords": np.concatenate([point_coords, corner_coords], axis=1).astype(np.float32),
+            "point_labels": np.concatenate([point_labels, corner_labels], axis=1).astype(np.float32),
+            "mask_input": np.asarray(mask_input, dtype=np.float32),
+            "has_mask_input": has_mask_input,
+            "orig_im_size": np.array(predictor.original_size, dtype=np.float32),
+        })
+        return masks[:, 0] > predictor.model.mask_threshold, logits[:, :1]
+
+
+# Decoder from the ONNX file at path, exported from sam first if the file does not exist yet.
+def load_decoder(sam, path):
+    if not os.path.exists(path):
+        print("exporting mask decoder to " + path)
+        export_decoder(sam, path)
+    return OnnxDecoder(path)
@@ -0,0 +1,161 @@
+import struct
+
+import numpy as np
+
+# Every message is a 4-byte little-endian length followed by that many bytes. Text commands carry UTF-8,
+# binary commands carry one of the payloads below, each starting with the protocol version it was written for.
+protocol_version = 1
+
+raw_encoding = 0
+rle_encoding = 1
+
+points_format = "<BI"
+modify_format = "<BBiiiiiii"
+mask_request_format = "<BB"
+mask_header_format = "<BBII"
+
+
+def recv_all(sock, n):
+    data = b''
+    while len(data) < n:
+        packet = sock.recv(n-len(data))
+        if not packet:
+            return None
+        data += packet
+    return data
+
+def recv_len(sock):
+    raw_bytes = recv_all(sock,4)
+    if raw_bytes is None:
+        return None
+    if len(raw_bytes) != 4:
+        return None
+    int_value = struct.unpack("<i",raw_bytes)[0]
+    return int_value
+
+def recv_bytes(sock):
+    msg_length = recv_len(sock)
+    if msg_length is None:
+        return None
+    return recv_all(sock, msg_length)
+
+def recv_msg(sock):
+    raw_msg = recv_bytes(sock)
+    if raw_msg is None:
+        return None
+    return raw_msg.decode()
+
+def send_frame(sock, payload):
+    sock.sendall(struct.pack("<i", len(payload)) + payload)
+
+
+# Version both sides speak, given the version the client asked for.
+def negotiate(client_version):
+    return min(int(client_version), protocol_version)
+
+
+def _check_version(version):
+    if version > protocol_version:
+        raise ValueError("unsupported protocol version " + str(version))
+
+
+# Prompt points: count, count (x, y) float32 pairs, then count uint8 labels (1 positive, 0 negative).
+def pack_points(points, labels):
+    points = np.asarray(points, dtype="<f4").reshape(-1, 2)
+    labels = np.asarray(labels, dtype=np.uint8)
+    return struct.pack(points_format, protocol_version, len(points)) + points.tobytes() + labels.tobytes()
+
+
+def unpack_points(payload):
+    version, count = struct.unpack_from(points_format, payload)
+    _check_version(version)
+    offset = struct.calcsize(points_format)
+    points = np.frombuffer(payload, dtype="<f4", count=count * 2, offset=offset).reshape(count, 2)
+    labels = np.frombuffer(payload, dtype=np.uint8, count=count, offset=offset + count * 8)
+    return points.astype(np.float64), labels.astype(np.int64)
+
+
+# One closed pen polygon: count, then count (x, y) float32 pairs.
+def pack_pen_stroke(points):
+    points = np.asarray(points, dtype="<f4").reshape(-1, 2)
+    return struct.pack(points_format, protocol_version, len(points)) + points.tobytes()
+
+
+def unpack_pen_stroke(payload):
+    version, count = struct.unpack_from(points_format, payload)
+    _check_version(version)
+    points = np.frombuffer(payload, dtype="<f4", count=count * 2, offset=struct.calcsize(points_format))
+    return points.reshape(count, 2).astype(np.float64)
+
+
+# All parameters of a Modify in one block: recursive flag, lod, bottom left tile, offset, ortho width and tile size,
+# followed by the cover mode and the terrain folder path as 2-byte length prefixed UTF-8 strings.
+def pack_modify(recursive, cover, terrain_folder_path, lod, bottom_left, offset, ortho_width, tile_size):
+    payload = struct.pack(modify_format, protocol_version, int(recursive), int(lod), int(bottom_left[0]),
+                          int(bottom_left[1]), int(offset[0]), int(offset[1]), int(ortho_width), int(tile_size))
+    for text in (cover, terrain_folder_path):
+        text = text.encode()
+        payload += struct.pack("<H", len(text)) + text
+    return payload
+
+
+# Returns the arguments of the text Modify command, in the same string form.
+def unpack_modify(payload):
+    fields = struct.unpack_from(modify_format, payload)
+    _check_version(fields[0])
+    recursive, lod, bottom_x, bottom_y, offset_x, offset_y, ortho_width, tile_size = fields[1:]
+    pos = struct.calcsize(modify_format)
+    texts = []
+    for _ in range(2):
+        length = struct.unpack_from("<H", payload, pos)[0]
+        texts.append(bytes(payload[pos + 2:pos + 2 + length]).decode())
+        pos += 2 + length
+    cover, terrain_folder_path = texts
+    return (bool(recursive), cover, terrain_folder_path, str(lod), [str(bottom_x), str(bottom_y)],
+            [str(offset_x), str(offset_y)], [str(ortho_width), str(tile_size)])
+
+
+def pack_mask_request(encoding):
+    return struct.pack(mask_request_format, protocol_version, encoding)
+
+
+def unpack_mask_request(payload):
+    version, encoding = struct.unpack_from(mask_request_format, payload)
+    _check_version(version)
+    return encoding
+
+
+# Run lengths of a boolean mask in row-major order, alternating between False and True and starting with False.
+def encode_rle(mask):
+    flat = np.ascontiguousarray(mask, dtype=bool).ravel()
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    runs = np.diff(np.concatenate(([0], changes, [flat.size])))
+    if flat.size and flat[0]:
+        runs = np.concatenate(([0], runs))
+    return runs.astype("<u4").tobytes()
+
+
+def decode_rle(data, shape):
+    runs = np.frombuffer(data, dtype="<u4")
+    values = np.arange(len(runs)) % 2 == 1
+    return np.repeat(values, runs).reshape(shape)
+
+
+# Segment mask reply: encoding, height and width, then one byte per pixel (0 or 1) or the RLE run lengths.
+def pack_mask(mask, encoding):
+    height, width = mask.shape
+    header = struct.pack(mask_header_format, protocol_version, encoding, height, width)
+    if encoding == rle_encoding:
+        return header + encode_rle(mask)
+    if encoding == raw_encoding:
+        return header + np.ascontiguousarray(mask, dtype=np.uint8).tobytes()
+    raise ValueError("unknown mask encoding " + str(encoding))
+
+
+def unpack_mask(payload):
+    version, encoding, height, width = struct.unpack_from(mask_header_format, payload)
+    _check_version(version)
+    data = payload[struct.calcsize(mask_header_format):]
+    if encoding == rle_encoding:
+        return decode_rle(data, (height, width))
+    return np.frombuffer(data, dtype=np.uint8).reshape(height, width).astype(bool)
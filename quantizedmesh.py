@@ -0,0 +1,49 @@
+import struct
+from collections import namedtuple
+
+header_size = 88
+oct_vertex_normals_extension = 1
+watermask_extension = 2
+metadata_extension = 4
+
+# Offset is where the extension data starts, right after its 4-byte length.
+Extension = namedtuple("Extension", ["id", "offset", "length"])
+
+
+# Header, mesh layout and extension table of a quantized-mesh terrain tile.
+# See https://github.com/CesiumGS/quantized-mesh for the format.
+class QuantizedMeshTile:
+    def __init__(self, data):
+        self.size = len(data)
+        pos = header_size
+        self.vertex_count = struct.unpack_from("<I", data, pos)[0]
+        pos += 4 + 2 * self.vertex_count * 3
+        # Indices are 32 bits wide and 4-byte aligned once vertices no longer fit in 16 bits.
+        index_size = 4 if self.vertex_count > 65536 else 2
+        pos += -pos % index_size
+        self.triangle_count = struct.unpack_from("<I", data, pos)[0]
+        pos += 4 + index_size * self.triangle_count * 3
+        self.edge_counts = []
+        for _ in range(4):
+            edge_count = struct.unpack_from("<I", data, pos)[0]
+            self.edge_counts.append(edge_count)
+            pos += 4 + index_size * edge_count
+        self.extensions_offset = pos
+        self.extensions = {}
+        while pos + 5 <= self.size:
+            extension_id, extension_length = struct.unpack_from("<BI", data, pos)
+            pos += 5
+            self.extensions[extension_id] = Extension(extension_id, pos, extension_length)
+            pos += extension_length
+
+    def extension(self, extension_id):
+        return self.extensions.get(extension_id)
+
+    # Position of the watermask length field, or -1 if the tile has no watermask.
+    @property
+    def watermask_pos(self):
+        watermask = self.extension(watermask_extension)
+        if watermask is None:
+            return -1
+        return watermask.offset - 4
+
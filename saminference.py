@@ -0,0 +1,48 @@
+import torch
+from segment_anything import sam_model_registry
+
+# Precisions the image encoder can run at. int8 quantizes the weights of its Linear layers dynamically and
+# runs on CPU only; bf16 runs the encoder under autocast and hands fp32 features to the decoder.
+encoder_precisions = ("fp32", "int8", "bf16")
+
+
+# Set the number of threads torch uses within one operation and across independent operations.
+# None keeps the torch default. The inter-op count can only be set before torch runs anything in parallel.
+def configure_threads(num_threads=None, num_interop_threads=None):
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads:
+        torch.set_num_interop_threads(num_interop_threads)
+    print("torch threads: " + str(torch.get_num_threads()) + ", inter-op threads: " +
+          str(torch.get_num_interop_threads()))
+
+
+# Image encoder running under bf16 autocast. Keeps img_size, which SamPredictor and the ONNX export read.
+class AutocastEncoder(torch.nn.Module):
+    def __init__(self, encoder, device_type):
+        super().__init__()
+        self.encoder = encoder
+        self.img_size = encoder.img_size
+        self.device_type = device_type
+
+    def forward(self, x):
+        with torch.autocast(self.device_type, dtype=torch.bfloat16):
+            return self.encoder(x).float()
+
+
+# Build a SAM model from a checkpoint on the device, with its image encoder at the given precision.
+def build_sam(model_type, checkpoint, device, precision="fp32"):
+    if precision not in encoder_precisions:
+        raise ValueError("unknown encoder precision " + str(precision))
+    sam = sam_model_registry[model_type](checkpoint=checkpoint)
+    sam.to(device=device)
+    sam.eval()
+    device_type = torch.device(device).type
+    if precision == "int8":
+        if device_type != "cpu":
+            raise ValueError("the int8 encoder runs on CPU only")
+        sam.image_encoder = torch.ao.quantization.quantize_dynamic(sam.image_encoder, {torch.nn.Linear},
+                                                                   dtype=torch.qint8)
+    elif precision == "bf16":
+        sam.image_encoder = AutocastEncoder(sam.image_encoder, device_type)
+    return sam
@@ -0,0 +1,301 @@
+import gzip
+import mmap
+import os
+import shutil
+import sqlite3
+import struct
+import tempfile
+import threading
+from pathlib import Path
+
+from quantizedmesh import QuantizedMeshTile, watermask_extension
+
+gzip_magic = b'\x1f\x8b'
+
+# Level gzip compressed tiles are written back at.
+gzip_level = 6
+
+
+# Replace a file with the given chunks of data, keeping its permissions.
+# The data goes to a temporary file next to it first, so a crash leaves either the old or the new file.
+# mkstemp creates that file readable by its owner only, so the mode of the old file is copied onto it.
+def replace_file(file_path, chunks):
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(file_path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            for chunk in chunks:
+                file.write(chunk)
+            file.flush()
+            os.fsync(file.fileno())
+        if os.path.exists(file_path):
+            shutil.copymode(file_path, temp_path)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+# Parse tile data, decompressing it first if it is gzip compressed.
+# Returns the tile and the decompressed data, or None for data that was not compressed.
+def parse_tile(data):
+    if data[:2] != gzip_magic:
+        return QuantizedMeshTile(data), None
+    data = gzip.decompress(data)
+    return QuantizedMeshTile(data), data
+
+
+# Tiles stored as {root}/{lod}/{x}/{y}.terrain files. Tile ids are the file paths.
+class DirectoryBackend:
+    suffix = ".terrain"
+
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def close(self):
+        pass
+
+    def tile_id(self, lod, x, y):
+        return self.root / str(lod) / str(x) / (str(y) + self.suffix)
+
+    def name(self, tile_id):
+        return str(tile_id)
+
+    def columns(self, lod):
+        return {int(entry.name) for entry in _scandir(self.root / str(lod)) if entry.name.isdigit() and entry.is_dir()}
+
+    def rows(self, lod, x):
+        rows = set()
+        for entry in _scandir(self.root / str(lod) / str(x)):
+            stem = entry.name[:-len(self.suffix)]
+            if entry.name.endswith(self.suffix) and stem.isdigit():
+                rows.add(int(stem))
+        return rows
+
+    def open_tile(self, tile_id):
+        with open(tile_id, 'rb') as file:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return parse_tile(data)
+
+    def read(self, tile_id):
+        with open(tile_id, 'rb') as file:
+            return file.read()
+
+    def read_range(self, tile_id, offset, length):
+        with open(tile_id, 'rb') as file:
+            file.seek(offset)
+            return file.read(length)
+
+    def patch(self, tile_id, offset, data):
+        with open(tile_id, 'rb+') as file:
+            file.seek(offset)
+            file.write(data)
+
+    def replace(self, tile_id, data):
+        replace_file(tile_id, (data,))
+
+
+def _scandir(path):
+    try:
+        with os.scandir(path) as entries:
+            return list(entries)
+    except FileNotFoundError:
+        return []
+
+
+# Tiles stored in one SQLite file using the MBTiles tiles table.
+# Tile rows are the y of the terrain tile scheme, which is already TMS for Cesium terrain.
+# The file must exist and have the table: the path comes from the client, and a mistyped one must not create
+# an empty tileset. Call close() when done with it.
+class SqliteBackend:
+    def __init__(self, path):
+        self.path = path
+        try:
+            self._connection = sqlite3.connect(Path(path).absolute().as_uri() + "?mode=rw", uri=True,
+                                               check_same_thread=False)
+        except sqlite3.OperationalError:
+            raise FileNotFoundError("cannot open tileset " + path)
+        self._lock = threading.Lock()
+        if not self._query("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'tiles'", ()):
+            self.close()
+            raise ValueError(path + " has no tiles table")
+
+    def close(self):
+        self._connection.close()
+
+    def tile_id(self, lod, x, y):
+        return int(lod), int(x), int(y)
+
+    def name(self, tile_id):
+        return self.path + ":" + "/".join(str(part) for part in tile_id)
+
+    def _query(self, sql, args):
+        with self._lock:
+            return self._connection.execute(sql, args).fetchall()
+
+    def columns(self, lod):
+        return {row[0] for row in self._query(
+            "SELECT DISTINCT tile_column FROM tiles WHERE zoom_level = ?", (int(lod),))}
+
+    def rows(self, lod, x):
+        return {row[0] for row in self._query(
+            "SELECT tile_row FROM tiles WHERE zoom_level = ? AND tile_column = ?", (int(lod), int(x)))}
+
+    def open_tile(self, tile_id):
+        return parse_tile(self.read(tile_id))
+
+    def read(self, tile_id):
+        rows = self._query(
+            "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?", tile_id)
+        if not rows:
+            raise FileNotFoundError(self.name(tile_id))
+        return bytes(rows[0][0])
+
+    def read_range(self, tile_id, offset, length):
+        rows = self._query(
+            "SELECT substr(tile_data, ?, ?) FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+            (offset + 1, length) + tile_id)
+        if not rows:
+            raise FileNotFoundError(self.name(tile_id))
+        return bytes(rows[0][0])
+
+    def patch(self, tile_id, offset, data):
+        tile = bytearray(self.read(tile_id))
+        tile[offset:offset + len(data)] = data
+        self.replace(tile_id, tile)
+
+    def replace(self, tile_id, data):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "UPDATE tiles SET tile_data = ? WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                (bytes(data),) + tile_id)
+
+
+# Terrain tileset seen through one backend.
+# Which tiles exist is read once per lod and column and kept; parsed tile headers are kept until the tile
+# is written through this store or clear_cache() is called. Create a new store to see changes made by others.
+# Gzip compressed tiles are recognized by their magic bytes and decompressed once, when first parsed. Their data
+# is kept until the tile is written or the cache is cleared, and they are written back compressed at compresslevel.
+class TerrainStore:
+    def __init__(self, backend, compresslevel=None):
+        self.backend = backend
+        self.compresslevel = gzip_level if compresslevel is None else compresslevel
+        self._columns = {}
+        self._rows = {}
+        self._tiles = {}
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def tile_id(self, lod, x, y):
+        return self.backend.tile_id(lod, x, y)
+
+    def name(self, tile_id):
+        return self.backend.name(tile_id)
+
+    def exists(self, lod, x, y):
+        lod, x, y = int(lod), int(x), int(y)
+        with self._lock:
+            columns = self._columns.get(lod)
+        if columns is None:
+            columns = self.backend.columns(lod)
+            with self._lock:
+                self._columns[lod] = columns
+        if x not in columns:
+            return False
+        with self._lock:
+            rows = self._rows.get((lod, x))
+        if rows is None:
+            rows = self.backend.rows(lod, x)
+            with self._lock:
+                self._rows[(lod, x)] = rows
+        return y in rows
+
+    def tile(self, tile_id):
+        with self._lock:
+            tile = self._tiles.get(tile_id)
+        if tile is None:
+            tile, data = self.backend.open_tile(tile_id)
+            with self._lock:
+                self._tiles[tile_id] = tile
+                if data is not None:
+                    self._data[tile_id] = data
+        return tile
+
+    # Decompressed data of a gzip compressed tile, None for a tile stored uncompressed.
+    def _compressed_data(self, tile_id):
+        self.tile(tile_id)
+        with self._lock:
+            return self._data.get(tile_id)
+
+    def _forget(self, tile_id):
+        with self._lock:
+            self._tiles.pop(tile_id, None)
+            self._data.pop(tile_id, None)
+
+    def clear_cache(self):
+        with self._lock:
+            self._tiles.clear()
+            self._data.clear()
+
+    # Drop the cache and release the backend, for example the connection to an SQLite file.
+    def close(self):
+        self.clear_cache()
+        self.backend.close()
+
+    def _replace(self, tile_id, data, compressed):
+        if compressed:
+            data = gzip.compress(data, self.compresslevel)
+        self.backend.replace(tile_id, data)
+        self._forget(tile_id)
+
+    # Current watermask of a tile, None if it has none.
+    def read_watermask(self, tile_id):
+        watermask = self.tile(tile_id).extension(watermask_extension)
+        if watermask is None:
+            return None
+        data = self._compressed_data(tile_id)
+        if data is not None:
+            return data[watermask.offset:watermask.offset + watermask.length]
+        return self.backend.read_range(tile_id, watermask.offset, watermask.length)
+
+    # Store a watermask in a tile.
+    # A watermask of the same size in an uncompressed tile is overwritten in place. Otherwise the tile is rebuilt
+    # with the new watermask in the place of the old one, or appended if there was none, keeping every other extension.
+    def write_watermask(self, tile_id, new_mask):
+        watermask = self.tile(tile_id).extension(watermask_extension)
+        data = self._compressed_data(tile_id)
+        compressed = data is not None
+        if not compressed:
+            if watermask is not None and watermask.length == len(new_mask):
+                self.backend.patch(tile_id, watermask.offset, new_mask)
+                return
+            data = self.backend.read(tile_id)
+        if watermask is None:
+            data_before_water, data_after_water = data, b''
+        else:
+            data_before_water = data[:watermask.offset - 5]
+            data_after_water = data[watermask.offset + watermask.length:]
+        header = struct.pack('<BI', watermask_extension, len(new_mask))
+        self._replace(tile_id, b''.join((data_before_water, header, new_mask, data_after_water)), compressed)
+
+    # Remove the watermask extension from a tile, keeping the other extensions.
+    def remove_watermask(self, tile_id):
+        watermask = self.tile(tile_id).extension(watermask_extension)
+        if watermask is None:
+            return
+        data = self._compressed_data(tile_id)
+        compressed = data is not None
+        if not compressed:
+            data = self.backend.read(tile_id)
+        self._replace(tile_id, data[:watermask.offset - 5] + data[watermask.offset + watermask.length:], compressed)
+
+
+sqlite_suffixes = (".mbtiles", ".sqlite", ".db")
+
+
+# Open the tileset at location: an SQLite file by its suffix, otherwise a directory.
+# Compressed tiles are written back at compresslevel, gzip_level by default.
+def open_terrain_store(location, compresslevel=None):
+    if str(location).lower().endswith(sqlite_suffixes):
+        return TerrainStore(SqliteBackend(str(location)), compresslevel)
+    return TerrainStore(DirectoryBackend(location), compresslevel)
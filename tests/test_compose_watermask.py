@@ -0,0 +1,125 @@
+import os
+import random
+import struct
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from tilemodifier import compose_watermask
+
+
+# get_new_watermask as it was before compose_watermask replaced its loops, frozen as the reference.
+# It takes the original watermask itself instead of reading it from a terrain file: None when the tile has none,
+# otherwise its bytes. Mask is a list of rows of b'\x00' or b'\xff', as analyse_mask() made them.
+def legacy_get_new_watermask(origin_mask, mask, i, j, ortho_width, tile_size, offset, cover):
+    new_mask = b''
+    if origin_mask is None:
+        for x in range(0, tile_size):
+            for y in range(0, tile_size):
+                if offset[1] <= x + i * tile_size <= offset[1] + ortho_width:
+                    if offset[0] <= y + j * tile_size <= offset[0] + ortho_width:
+                        new_mask += mask[x + i * tile_size - offset[1] - 1][y + j * tile_size - offset[0] - 1]
+                    else:
+                        new_mask += b'\x00'
+                else:
+                    new_mask += b'\x00'
+    else:
+        origin_length = len(origin_mask)
+        if origin_length == 1:
+            for x in range(0, tile_size):
+                for y in range(0, tile_size):
+                    if offset[1] <= x + i * tile_size <= offset[1] + ortho_width:
+                        if offset[0] <= y + j * tile_size <= offset[0] + ortho_width:
+                            if cover == "Fill":
+                                if mask[x + i * tile_size - offset[1]][
+                                    y + j * tile_size - offset[0]] != b'\x00':
+                                    new_mask += mask[x + i * tile_size - offset[1]][
+                                        y + j * tile_size - offset[0]]
+                                else:
+                                    if origin_mask == 0:
+                                        new_mask += b'\x00'
+                                    else:
+                                        new_mask += b'\xff'
+                            else:
+                                new_mask += mask[x + i * tile_size - offset[1] - 1][
+                                    y + j * tile_size - offset[0] - 1]
+                        else:
+                            if origin_mask == 0:
+                                new_mask += b'\x00'
+                            else:
+                                new_mask += b'\xff'
+                    else:
+                        if origin_mask == 0:
+                            new_mask += b'\x00'
+                        else:
+                            new_mask += b'\xff'
+        else:
+            for x in range(0, tile_size):
+                for y in range(0, tile_size):
+                    if offset[1] <= x + i * tile_size <= offset[1] + ortho_width and offset[0] <= y + j * tile_size <= \
+                            offset[0] + ortho_width:
+                        if cover == "Fill":
+                            if mask[x + i * tile_size - offset[1] - 1][
+                                y + j * tile_size - offset[0] - 1] != b'\x00':
+                                new_mask += mask[x + i * tile_size - offset[1] - 1][
+                                    y + j * tile_size - offset[0] - 1]
+                            else:
+                                new_mask += struct.pack('B', origin_mask[x * tile_size + y])
+                        else:
+                            new_mask += mask[x + i * tile_size - offset[1] - 1][
+                                y + j * tile_size - offset[0] - 1]
+                    else:
+                        new_mask += struct.pack('B', origin_mask[x * tile_size + y])
+    return new_mask
+
+
+def random_origin(rng, kind, tile_size):
+    if kind == "none":
+        return None
+    if kind == "one":
+        return bytes([rng.choice([0, 255])])
+    return np.random.default_rng(rng.randrange(1 << 30)).integers(0, 256, tile_size * tile_size,
+                                                                  dtype=np.uint8).tobytes()
+
+
+# compose_watermask against the legacy loops on seeded random masks, offsets, tile positions, watermask kinds and
+# cover modes. Small tiles keep the legacy byte concatenation fast; the last cases use the real 256 pixel tiles.
+class ComposeWatermaskTest(unittest.TestCase):
+    def check(self, seed, tile_size, widths):
+        rng = random.Random(seed)
+        ortho_width = rng.choice(widths)
+        mask = np.random.default_rng(seed).random((ortho_width, ortho_width)) < 0.5
+        legacy_mask = [[b'\xff' if value else b'\x00' for value in row] for row in mask.tolist()]
+        kind = rng.choice(["none", "one", "full"])
+        origin = random_origin(rng, kind, tile_size)
+        cover = rng.choice(["Fill", "Cover"])
+        offset = [rng.randrange(0, tile_size), rng.randrange(0, tile_size)]
+        i = rng.randrange(0, ortho_width // tile_size + 2)
+        j = rng.randrange(0, ortho_width // tile_size + 2)
+        try:
+            expected = legacy_get_new_watermask(origin, legacy_mask, i, j, ortho_width, tile_size, offset, cover)
+        except IndexError:
+            # Filling a uniform watermask read past the last mask row; compose_watermask wraps it like the first.
+            self.assertEqual((kind, cover), ("one", "Fill"))
+            return
+        composed = compose_watermask(mask.astype(np.uint8) * 0xff, origin, i, j, ortho_width, tile_size, offset,
+                                     cover)
+        self.assertEqual(composed.tobytes(), expected,
+                         (seed, kind, cover, offset, i, j, ortho_width))
+
+    def test_small_tiles(self):
+        for seed in range(300):
+            with self.subTest(seed=seed):
+                self.check(seed, 16, [16, 24, 32, 40, 64])
+
+    def test_full_size_tiles(self):
+        for seed in range(4):
+            with self.subTest(seed=seed):
+                self.check(seed, 256, [256, 300, 512])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from tilemodifier import pen_process
+
+
+# point_in_polygon and pen_process as they were before the scanline rasterizer, frozen as the reference.
+def legacy_point_in_polygon(x, y, poly):
+    inside = False
+    n = len(poly)
+    p1x, p1y = poly[0]
+    for i in range(1, n + 1):
+        p2x, p2y = poly[i % n]
+        if min(p1y, p2y) < y <= max(p1y, p2y):
+            xinters = (y - p1y) * (p2x - p1x) / (p2y - p1y + 1e-10) + p1x
+            if x <= xinters:
+                inside = not inside
+        p1x, p1y = p2x, p2y
+    return inside
+
+
+def legacy_pen_process(points, mask):
+    for y in range(mask.shape[0]):
+        for x in range(mask.shape[1]):
+            if legacy_point_in_polygon(x + 0.5, y + 0.5, points):
+                mask[y][x] = True
+    return mask
+
+
+class PenProcessTest(unittest.TestCase):
+    def check(self, polygon, shape):
+        expected = legacy_pen_process(polygon, np.zeros(shape, dtype=bool))
+        filled = pen_process(np.array(polygon, dtype=np.float64), np.zeros(shape, dtype=bool))
+        np.testing.assert_array_equal(filled, expected)
+        return filled
+
+    def test_polygon_outside_the_view(self):
+        # Right of the view, with rows inside it.
+        self.assertFalse(self.check([[110, 10], [130, 10], [120, 40]], (100, 100)).any())
+        # Below the view, with columns inside it.
+        self.assertFalse(self.check([[5, 30], [15, 30], [10, 40]], (20, 20)).any())
+        # Off both axes.
+        self.assertFalse(self.check([[-30, -30], [-10, -30], [-20, -10]], (20, 20)).any())
+
+    def test_polygon_partly_outside_the_view(self):
+        self.assertTrue(self.check([[80, 10], [130, 10], [120, 60]], (100, 100)).any())
+        self.assertTrue(self.check([[-10, -10], [12.5, -5], [6, 17.3]], (20, 20)).any())
+        self.check([[5, 15], [15, 15], [10, 40], [2, 25]], (20, 20))
+
+    def test_strokes_outside_and_inside_the_view(self):
+        strokes = [np.array([[110, 10], [130, 10], [120, 40]]), np.array([[10, 10], [30, 10], [20, 40]])]
+        expected = legacy_pen_process(strokes[1].tolist(), np.zeros((100, 100), dtype=bool))
+        np.testing.assert_array_equal(pen_process(strokes, np.zeros((100, 100), dtype=bool)), expected)
+
+    def test_single_polygon_as_list(self):
+        polygon = [[0, 0], [10, 0], [10, 10], [0, 10]]
+        filled = pen_process(polygon, np.zeros((20, 20), dtype=bool))
+        self.assertEqual(filled.sum(), 100)
+        np.testing.assert_array_equal(filled, legacy_pen_process(polygon, np.zeros((20, 20), dtype=bool)))
+        polygon = [(2.5, 1), (17, 4.5), (9, 18)]
+        np.testing.assert_array_equal(pen_process(polygon, np.zeros((20, 20), dtype=bool)),
+                                      legacy_pen_process(polygon, np.zeros((20, 20), dtype=bool)))
+
+    def test_list_of_list_polygons(self):
+        strokes = [[[0, 0], [10, 0], [10, 10], [0, 10]], [[12, 12], [18, 12], [15, 19]]]
+        expected = np.zeros((20, 20), dtype=bool)
+        for stroke in strokes:
+            legacy_pen_process(stroke, expected)
+        np.testing.assert_array_equal(pen_process(strokes, np.zeros((20, 20), dtype=bool)), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
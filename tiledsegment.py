@@ -0,0 +1,100 @@
+import numpy as np
+
+from embeddingcache import Embedding, restore_embedding
+
+# Windows are the size SAM encodes at, so their pixels are not downscaled.
+window_size = 1024
+default_window_overlap = 128
+encode_batch_size = 4
+
+
+# Starts of the windows covering [0, length), spread evenly so that neighbours share at least overlap pixels.
+def window_starts(length, size, overlap):
+    if length <= size:
+        return [0]
+    count = -(-(length - size) // (size - overlap)) + 1
+    return sorted({round(k * (length - size) / (count - 1)) for k in range(count)})
+
+
+# Blending weight of every pixel of a window. It ramps up over the overlap from the edges the window shares with
+# its neighbours, so the prediction made further from a window border wins; edges on the image border stay at 1.
+def window_weights(bounds, shape, overlap):
+    y0, x0, y1, x1 = bounds
+
+    def ramp(start, stop, length):
+        index = np.arange(start, stop)
+        distance = np.full(stop - start, np.inf)
+        if start > 0:
+            distance = np.minimum(distance, index - start)
+        if stop < length:
+            distance = np.minimum(distance, stop - 1 - index)
+        return np.minimum((distance + 1) / (overlap + 1), 1)
+
+    return np.minimum.outer(ramp(y0, y1, shape[0]), ramp(x0, x1, shape[1])).astype(np.float32)
+
+
+# An exported view too large for one encoder pass, split into overlapping windows of window_size pixels,
+# each with its own image embedding.
+class ImageWindows:
+    def __init__(self, shape, overlap=default_window_overlap, size=window_size):
+        self.shape = tuple(shape[:2])
+        self.overlap = overlap
+        height, width = self.shape
+        self.bounds = [(y, x, min(y + size, height), min(x + size, width))
+                       for y in window_starts(height, size, overlap) for x in window_starts(width, size, overlap)]
+        self.embeddings = [None] * len(self.bounds)
+
+    def __len__(self):
+        return len(self.bounds)
+
+    def crop(self, image, index):
+        y0, x0, y1, x1 = self.bounds[index]
+        return image[y0:y1, x0:x1]
+
+    # Windows holding any of the (x, y) points or overlapping the (x0, y0, x1, y1) box.
+    def touching(self, points, box=None):
+        indices = []
+        for index, (y0, x0, y1, x1) in enumerate(self.bounds):
+            inside = any(x0 <= x < x1 and y0 <= y < y1 for x, y in points)
+            if box is not None:
+                inside = inside or (box[0] < x1 and x0 <= box[2] and box[1] < y1 and y0 <= box[3])
+            if inside:
+                indices.append(index)
+        return indices
+
+    # Compute the embedding of every window, taking those seen before from the cache and running the encoder
+    # on the others encode_batch_size windows at a time.
+    def encode(self, predictor, image, cache=None):
+        import torch
+
+        keys = [None] * len(self)
+        missing = []
+        for index in range(len(self)):
+            if cache is not None:
+                keys[index] = cache.key(np.ascontiguousarray(self.crop(image, index)))
+                self.embeddings[index] = cache.get(keys[index])
+            if self.embeddings[index] is None:
+                missing.append(index)
+        for start in range(0, len(missing), encode_batch_size):
+            batch = missing[start:start + encode_batch_size]
+            inputs = []
+            for index in batch:
+                window = predictor.transform.apply_image(np.ascontiguousarray(self.crop(image, index)))
+                window = torch.as_tensor(window, device=predictor.device).permute(2, 0, 1).contiguous()[None, :, :, :]
+                inputs.append((window.shape[-2:], predictor.model.preprocess(window)))
+            with torch.no_grad():
+                features = predictor.model.image_encoder(torch.cat([input_image for size, input_image in inputs]))
+            for k, index in enumerate(batch):
+                y0, x0, y1, x1 = self.bounds[index]
+                # A copy, as a slice would keep the features of the whole batch alive in the cache and on disk.
+                embedding = Embedding(features[k:k + 1].clone(), (y1 - y0, x1 - x0), tuple(inputs[k][0]))
+                self.embeddings[index] = embedding
+                if cache is not None:
+                    cache.put(keys[index], embedding)
+        print(str(len(self)) + " windows, " + str(len(missing)) + " encoded")
+
+    def restore(self, predictor, index):
+        restore_embedding(predictor, self.embeddings[index])
+
+    def weights(self, index):
+        return window_weights(self.bounds[index], self.shape, self.overlap)